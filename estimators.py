@@ -1,11 +1,13 @@
 import numpy as np
 import random
-from scipy.fftpack import dct, idct
+from scipy.fft import dct, idct, rfft, irfft
 import matplotlib.pyplot as plt
 from util import save_data, get_filepath, deterministic_sample, get_numeric_class_vars, gini
 from plot_util import pin_plot
 import inspect
 import math
+from joblib import Parallel, delayed
+from numba import njit
 import qinfer
 from qinfer import SimplePrecessionModel, Distribution, LiuWestResampler, FiniteOutcomeModel
 
@@ -28,21 +30,65 @@ q_e1      = 1-q_e0  # P(m=1 | e)
 ################################################################################
 ##                            Basic Functions                                 ##
 
-def prob_excited(t, omega):
-    """ probability of excitation at time t for a given value of omega
-        -> assumes zero detuning
-    """
-    return 0.5 * (1. - np.cos(omega * t) * np.exp(- 0.5 * v_0 * t))
+if v_0 == 0.:
+    # specialize at import time: with no noise in omega the decoherence
+    # factor exp(-0.5*v_0*t) is identically 1, so skip evaluating it
+    def prob_excited(t, omega):
+        """ probability of excitation at time t for a given value of omega
+            -> assumes zero detuning (and v_0 == 0, so no decoherence)
+        """
+        return 0.5 * (1. - np.cos(omega * t))
+else:
+    def prob_excited(t, omega):
+        """ probability of excitation at time t for a given value of omega
+            -> assumes zero detuning
+        """
+        return 0.5 * (1. - np.cos(omega * t) * np.exp(- 0.5 * v_0 * t))
 
 def likelihood(omega, t, m):
     """ Returns likelihood, where m is the result of a measurement. """
+    w_e = m*q_e1 + (1 - m)*q_e0 # P(m | e)
+    w_g = m*q_g1 + (1 - m)*q_g0 # P(m | g)
     pe = prob_excited(t, omega)
-    return pe*(m*q_e1 + (1 - m)*q_e0) + (1 - pe)*(m*q_g1 + (1 - m)*q_g0)
+    if np.ndim(w_e) == 0: # common case: scalar m, so update pe in place
+        pe *= w_e - w_g
+        pe += w_g
+        return pe
+    return w_g + pe * (w_e - w_g)
 
 def normalize(dist):
     """ normalize a discrete probability distribution """
     return dist / np.sum(dist)
 
+@njit(fastmath=True, cache=True)
+def _update_kernel(dist, cos_omega_t, decay, m):
+    """ multiply dist by the likelihood of measurement m, given the
+        (possibly cached) values of cos(omega*t) and the decoherence factor
+        exp(-0.5*v_0*t), then renormalize, all in a single fused pass. dist
+        has one row per omega (1d dists pass a view of shape (n, 1)). """
+    w_e = q_e1 if m == 1 else q_e0
+    w_g = q_g1 if m == 1 else q_g0
+    s = 0.
+    for i in range(dist.shape[0]):
+        pe = 0.5 * (1. - cos_omega_t[i] * decay)
+        w = w_g + pe * (w_e - w_g)
+        for j in range(dist.shape[1]):
+            dist[i, j] *= w
+            s += dist[i, j]
+    inv = 1. / s
+    for i in range(dist.shape[0]):
+        for j in range(dist.shape[1]):
+            dist[i, j] *= inv
+
+def _grid_cos(grid_dist, t):
+    """ cos(omegas*t) for a grid dist, cached for the last t seen: choosers
+        like ConstantChooser and FittingChooser reuse the same t many
+        times, and this is the only omega-length transcendental per update """
+    if t != grid_dist._cos_t:
+        grid_dist._cos_t = t
+        grid_dist._cos = np.cos(grid_dist.omegas.ravel() * t)
+    return grid_dist._cos
+
 def clip_omega(omegas):
     return np.clip(omegas, omega_min, omega_max)
 
@@ -53,23 +99,55 @@ def perturb_omega(omega, v1):
     else:
         return clip_omega(omega + np.sqrt(v1) * np.random.randn())
 
+def _cached_on_array(cache, arr, compute):
+    """ look up a derived quantity of arr, recomputing only when the cached
+        entry belongs to a different array object """
+    entry = cache.get(id(arr))
+    if entry is None or entry[0] is not arr:
+        if len(cache) > 64: # keep the cache from growing without bound
+            cache.clear()
+        entry = (arr, compute(arr))
+        cache[id(arr)] = entry
+    return entry[1]
+
+_cdf_cache = {}
+def _get_cdf(dist):
+    """ cumsum of dist, cached since the same prior is sampled many times """
+    return _cached_on_array(_cdf_cache, dist, np.cumsum)
+
+def _compute_midpoints(values):
+    extvals = np.concatenate((values[0:1], values, values[-1:]))
+    return (extvals[:-1] + extvals[1:]) / 2
+
+_midpoint_cache = {}
+def _get_midpoints(values):
+    """ midpoints between neighbouring values, with the end values
+        duplicated so midpoints[i], midpoints[i+1] bracket values[i] """
+    return _cached_on_array(_midpoint_cache, values, _compute_midpoints)
+
 def sample_dist(values, dist, size=None):
     """ Randomly samples from a distribution, interpolating between points.
         Values should be in sorted order.
         dist is a probability distribution on values. """
-    i = 1 + np.random.choice(np.arange(0, len(values)), p=dist, size=size)
-    extvals = np.concatenate((values[0:1], values, values[-1:]))
-    return np.random.uniform(
-        (extvals[i-1] + extvals[i])/2,
-        (extvals[i] + extvals[i+1])/2 )
+    cdf = _get_cdf(dist)
+    i = np.searchsorted(cdf,
+        np.random.uniform(0., cdf[-1], size=size), side='right')
+    midpoints = _get_midpoints(values)
+    return np.random.uniform(midpoints[i], midpoints[i+1])
 
 def sample_omega_list(omegas, prior, v1, t_u_list):
     """ sample omega from the prior, then simulate random drift over time """
     omega0 = sample_dist(omegas, prior)
-    omega_list = [omega0]
-    for i in range(1, len(t_u_list)):
-        omega_list.append(perturb_omega(
-            omega_list[-1], v1 * (t_u_list[i] - t_u_list[i-1]) ))
+    steps = ( np.random.normal(0., 1., len(t_u_list) - 1) *
+        np.sqrt(v1 * np.diff(t_u_list)) )
+    omega_list = omega0 + np.concatenate(([0.], np.cumsum(steps)))
+    if np.all((omega_list >= omega_min) & (omega_list <= omega_max)):
+        return omega_list # clipping never binds, so the cumsum walk is exact
+    # otherwise replay the walk step by step so that each point is clipped
+    # before the next step is taken
+    for i in range(1, len(omega_list)):
+        omega_list[i] = min(max(
+            omega_list[i-1] + steps[i-1], omega_min), omega_max)
     return omega_list
 
 def measure(omega, t):
@@ -103,10 +181,10 @@ def heat_evolve(omegas, dist, v_tot):
     else: # if v_tot is too big, we use eigenfunction decomposition instead
         diff = omega_max - omega_min
         fact = (v_tot * np.pi**2) / (2. * diff**2) # update factor
-        cos_coeffs = dct(dist) # switch to fourier space. (in terms of cosines to get Neumann BC)
+        cos_coeffs = dct(dist, type=2, overwrite_x=True, workers=-1) # switch to fourier space. (in terms of cosines to get Neumann BC)
         n = np.arange(cos_coeffs.size)
         cos_coeffs *= np.exp( - fact * n**2 ) # heat eq update
-        return np.abs(idct(cos_coeffs) / (2 * cos_coeffs.size)) # switch back to the usual representation
+        return np.abs(idct(cos_coeffs, type=2, overwrite_x=True, workers=-1)) # switch back to the usual representation
 
 ##                                                                            ##
 ################################################################################
@@ -116,7 +194,7 @@ class ParticleDist1D:
     """ Represents a probability distribution using weighted particles.
         RULE: all method calls should leave the distribution normalized. """
     def normalize(self):
-        self.dist = normalize(self.dist)
+        self.dist /= np.sum(self.dist) # in place: self.dist is always owned
     def mean_omega(self):
         return np.sum(self.dist * self.omegas)
     def mean_log_v1(self):
@@ -134,18 +212,56 @@ class GridDist1D(ParticleDist1D):
         self.omegas = np.copy(omegas)
         self.dist = np.copy(prior)
         self.v1 = v1
-        
+        # cache the per-mode damping factors for one u of drift, so that
+        # wait_u is just a DCT, a multiply, and an inverse DCT
+        fact = (self.v1 * np.pi**2) / (2. * (omegas[-1] - omegas[0])**2)
+        self._damp = np.exp(-fact * np.arange(self.size)**2)
+        # twiddle factors for computing the DCT from a single length-2N real
+        # FFT of the mirrored dist (Van Loan), cached for reuse every call
+        self._tw = np.exp(-0.5j * np.pi * np.arange(self.size) / self.size)
+        self._itw = np.conj(self._tw)
+        # fold the damping into the inverse twiddle for the common n_u == 1
+        # case, and keep a persistent spectrum buffer (its last entry is
+        # identically zero for a mirrored real signal), so wait_u does one
+        # fewer multiply and one fewer allocation per call
+        self._damp_itw = self._damp * self._itw
+        self._spectrum = np.zeros(self.size + 1, dtype=complex)
+        self._cos_t, self._cos = None, None # single-slot cos(omegas*t) cache
     def wait_u(self, n_u=1.):
         """ given a posterior distribution for omega at time T,
             we find the dist for omega at time T+u
             or, if the optional n_u argument is not 1, at time T + n_u*u """
-        v_tot = self.v1 * n_u
-        self.dist = heat_evolve(self.omegas, self.dist, v_tot)
+        if self.v1 * n_u == 0.:
+            return
+        cos_coeffs = np.real(
+            rfft(np.concatenate((self.dist, self.dist[::-1])))[:self.size] * self._tw )
+        self._spectrum[:self.size] = cos_coeffs * (
+            self._damp_itw if n_u == 1. else self._damp**n_u * self._itw )
+        self.dist = np.abs(irfft(self._spectrum)[:self.size])
         self.normalize()
     def update(self, t, m):
         """ update distribution based on a measurement """
-        self.dist *= likelihood(self.omegas, t, m)
-        self.normalize()
+        decay = 1. if v_0 == 0. else math.exp(-0.5 * v_0 * t)
+        _update_kernel(self.dist.reshape((self.size, 1)),
+            _grid_cos(self, t), decay, m)
+    def many_update(self, ts, ms, n_us=None):
+        """ process a whole pre-recorded sequence of measurements at once.
+            n_us[i] is the waiting time between measurements i and i+1;
+            if omitted, the measurements are taken back to back.
+            When v1 == 0 the wait steps are the identity, so the pointwise
+            likelihoods commute and the entire sequence reduces to a single
+            vectorized pass (done in log space to avoid underflow). """
+        ts, ms = np.asarray(ts), np.asarray(ms)
+        if self.v1 == 0.:
+            weights = likelihood(self.omegas[:, np.newaxis], ts, ms)
+            log_lik = np.sum(np.log(weights), axis=1)
+            self.dist *= np.exp(log_lik - np.max(log_lik))
+            self.normalize()
+        else:
+            for i in range(len(ts)):
+                if i > 0:
+                    self.wait_u(1. if n_us is None else n_us[i-1])
+                self.update(ts[i], ms[i])
 
 class DynamicDist1D(ParticleDist1D):
     """ particles are not regularly spaced and can move around over time """
@@ -172,7 +288,10 @@ class DynamicDist1D(ParticleDist1D):
         if self.n_ess() < self.n_ess_limit * self.size:
             self.resample() # resample only if necessary
     def cov(self):
-        return np.cov(self.omegas, ddof=0, aweights=self.dist)
+        # direct weighted variance (self.dist is always normalized);
+        # np.cov allocates several intermediates we don't need
+        mu = np.sum(self.dist * self.omegas)
+        return np.sum(self.dist * (self.omegas - mu)**2)
     def n_ess(self):
         """ returns the effective sample size """
         return 1. / np.sum(self.dist**2)
@@ -251,14 +370,14 @@ class ParticleDist2D:
     """ Represents a 2d probability dist using weighted particles
         RULE: all fn calls should leave the dist normalized """
     def normalize(self):
-        self.dist = normalize(self.dist)
+        self.dist /= np.sum(self.dist) # in place: self.dist is always owned
     def mean_omega(self):
         return np.sum(self.dist * self.omegas)
     def mean_log_v1(self):
-        return np.sum(self.dist * np.log(self.v1s))
+        return np.sum(self.dist * self._log_v1s)
     def sample_omega(self, n):
         """ Take n samples of omega from this distribution. """
-        return np.random.choice(self.omegas.flatten(), 
+        return np.random.choice(self.omegas.flatten(),
             p=normalize(np.abs(np.sum(self.dist, axis=1))), size=n)
 
 class GridDist2D(ParticleDist2D):
@@ -270,16 +389,27 @@ class GridDist2D(ParticleDist2D):
         self.shape = prior.shape
         self.omegas = np.copy(omegas).reshape((omegas.size, 1))
         self.v1s = np.copy(v1s).reshape((1, v1s.size))
-        self.dist = np.copy(prior)
+        self._log_v1s = np.log(self.v1s) # v1s never changes, so log it once
+        # the dist is kept in float32: it is renormalized every update, so
+        # single precision is plenty, and it halves the memory traffic
+        # through the DCTs and likelihood multiplies. (the omega/v1 grids
+        # stay float64 so the means computed from them stay accurate.)
+        self.dist = np.asarray(prior, dtype=np.float32)
+        # cache the per-mode damping factors (one column per v1) for one u
+        # of drift, so wait_u handles all the v1 columns in a single DCT
+        fact = (self.v1s * np.pi**2) / (2. * (omegas[-1] - omegas[0])**2)
+        self._damp = np.exp(-fact * np.arange(omegas.size)[:, np.newaxis]**2,
+            dtype=np.float32)
+        self._cos_t, self._cos = None, None # single-slot cos(omegas*t) cache
     def wait_u(self, n_u=1.):
         """ given a posterior distribution for omega at time t,
             we find the dist for omega at time t+u """
-        v_tots = self.v1s.flatten() * n_u
-        for i, v_tot in enumerate(v_tots):
-            self.dist[:,i] = heat_evolve(self.omegas.flatten(), self.dist[:,i], v_tot)
+        cos_coeffs = dct(self.dist, axis=0, type=2, overwrite_x=True, workers=-1)
+        cos_coeffs *= self._damp if n_u == 1. else self._damp**n_u
+        self.dist = np.abs(idct(cos_coeffs, axis=0, type=2, overwrite_x=True, workers=-1))
     def update(self, t, m):
-        self.dist *= likelihood(self.omegas, t, m)
-        self.normalize()
+        decay = 1. if v_0 == 0. else math.exp(-0.5 * v_0 * t)
+        _update_kernel(self.dist, _grid_cos(self, t), decay, m)
 
 def covmax2d(cov1, cov2):
     """ a helper function for DynamicDist2D, this function
@@ -305,16 +435,24 @@ class DynamicDist2D(ParticleDist2D, DynamicDist1D):
     b = 1.
     def __init__(self, omegas, v1s, prior, size):
         self.size = size
-        self.log_v1_min, self.log_v1_max = np.log(v1s[0]), np.log(v1s[-1])
-        log_v1s, omegas = np.meshgrid(np.log(v1s), omegas)
-        indices = np.random.choice(np.arange(prior.size), p=prior.flatten(), size=self.size)
-        selected_omegas = omegas.flatten()[indices]
-        selected_log_v1s = log_v1s.flatten()[indices]
-        self.vals = np.stack([selected_omegas, selected_log_v1s], axis=0)
+        log_v1s = np.log(v1s)
+        self.log_v1_min, self.log_v1_max = log_v1s[0], log_v1s[-1]
+        # ravel is a view for contiguous priors, where flatten always copies
+        indices = np.random.choice(prior.size,
+            p=np.ascontiguousarray(prior).ravel(), size=self.size)
+        # index math instead of materializing the full (omega, v1) meshgrid
+        omega_idxs, v1_idxs = np.divmod(indices, v1s.size)
+        self.vals = np.stack([omegas[omega_idxs], log_v1s[v1_idxs]], axis=0)
         self.dist = normalize(np.ones(self.size))
         self.target_cov = self.cov()
     def cov(self):
-        return np.cov(self.vals, ddof=0, aweights=self.dist)
+        # unrolled 2x2 weighted covariance (self.dist is always normalized)
+        w = self.dist
+        d0 = self.vals[0] - np.sum(w * self.vals[0])
+        d1 = self.vals[1] - np.sum(w * self.vals[1])
+        return np.array([
+            [np.sum(w * d0 * d0), np.sum(w * d0 * d1)],
+            [np.sum(w * d0 * d1), np.sum(w * d1 * d1)] ])
     def wait_u(self, n_u=1.):
         self.vals[0] = perturb_omega(self.vals[0], np.exp(self.vals[1]) * n_u)
         self.target_cov += np.array([[self.mean_v1() * n_u, 0.], [0., 0.]])
@@ -451,6 +589,31 @@ class RandomChooser(TimeChooser):
     def get_t(self, dist):
         return np.random.uniform(0., t_max)
 
+@njit(cache=True)
+def _two_point_search(omega1, omega2, t_max, search_depth):
+    """ the tight integer search loop from TwoPointChooser.get_t: find the
+        (n, m) pair whose tau_n and tau_m times agree most closely while
+        staying below t_max """
+    n, m = 0, 0
+    nb, mb = 0, 0 # best n, best m
+    tau_n = np.pi * (2*n + 1) / abs(omega1 - omega2)
+    tau_m = np.pi * (2*m + 1) / (omega1 + omega2)
+    min_diff = abs(tau_n - tau_m)
+    for i in range(search_depth):
+        if tau_n < tau_m:
+            n += 1
+            tau_n = np.pi * (2*n + 1) / abs(omega1 - omega2)
+        else:
+            m += 1
+            tau_m = np.pi * (2*m + 1) / (omega1 + omega2)
+        if max(tau_n, tau_m) > t_max:
+            break
+        diff = abs(tau_n - tau_m)
+        if diff < min_diff:
+            min_diff = diff
+            nb, mb = n, m
+    return nb, mb
+
 class TwoPointChooser(TimeChooser):
     """ uses a heuristic method to choose t
         obsolete compared to OptimizingChooser """
@@ -465,7 +628,8 @@ class TwoPointChooser(TimeChooser):
         """ choose a good t for the next experiment. """
         if np.random.binomial(1, 0.2): # some chance of just picking t randomly
             return np.random.uniform(0., t_max)
-        self.omega1, self.omega2 = np.sort(dist.sample_omega(16))[np.array([0, -1])]
+        samples = dist.sample_omega(16) # only the extremes are needed
+        self.omega1, self.omega2 = samples.min(), samples.max()
         if self.omega1 == self.omega2: # just choose a large time
             return np.random.uniform(0.7 * t_max, t_max)
         if self.tau_m(0) > t_max:
@@ -473,20 +637,8 @@ class TwoPointChooser(TimeChooser):
         if self.tau_n(0) > t_max:
             return self.tau_m(np.floor(
                 (t_max * (self.omega1 + self.omega2) / np.pi - 1) / 2 ))
-        n, m = 0, 0
-        nb, mb = 0, 0 # best n, best m
-        min_diff = abs(self.tau_n(n) - self.tau_m(m))
-        for i in range(self.search_depth):
-            if self.tau_n(n) < self.tau_m(m):
-                n += 1
-            else:
-                m += 1
-            if max(self.tau_n(n), self.tau_m(m)) > t_max:
-                break
-            diff = abs(self.tau_n(n) - self.tau_m(m))
-            if diff < min_diff:
-                min_diff = diff
-                nb, mb = n, m
+        nb, mb = _two_point_search(self.omega1, self.omega2, t_max,
+            self.search_depth)
         if self.tau_n(nb) > t_max:
             return self.tau_m(mb)
         else:
@@ -534,11 +686,12 @@ class Estimator:
             was taken, this time being measured in u's. If omitted, they are
             assumed to be spaced evenly, with a separation of 1u. """
         length = len(omega_list)
-        t_hist, t_omega_hat_hist = [], []
+        t_hist = np.empty(length)
+        t_omega_hat_hist = np.empty(length)
         for i in range(length):
             t = self.chooser.get_t(self.dist)
-            t_hist.append(t)
-            t_omega_hat_hist.append(t * self.mean_omega())
+            t_hist[i] = t
+            t_omega_hat_hist[i] = t * self.mean_omega()
             m = measure(omega_list[i], t)
             if i > 0:
                 if t_u_list is None:
@@ -561,17 +714,24 @@ class Simulator:
             self.get_t_u_list = (lambda x, r, v1: None)
         else:
             self.get_t_u_list = get_t_u_list
+    def do_run(self, x, r):
+        """ do a single monte carlo run, returning its losses """
+        # give each run its own reproducible stream, so runs stay distinct
+        # when they are farmed out to parallel workers
+        random_seed(x, r, randomizer=1)
+        v1 = self.get_v1(x, r) # [1/s^2/u] (u is the time between measurements)
+        estimator = self.get_estimator(x, r, v1)
+        t_u_list = self.get_t_u_list(x, r, v1)
+        omega_list = self.get_omega_list(x, r, v1, t_u_list)
+        estimator.many_measure(omega_list, t_u_list)
+        return ( (omega_list[-1] - estimator.mean_omega())**2,
+                 (np.log(v1) - estimator.mean_log_v1())**2 )
     def do_runs(self, x, n_runs):
-        """ get the losses for a large number of runs """
-        loss_omega_list, loss_v1_list = np.zeros(n_runs), np.zeros(n_runs)
-        for r in range(n_runs):
-            v1 = self.get_v1(x, r) # [1/s^2/u] (u is the time between measurements)
-            estimator = self.get_estimator(x, r, v1)
-            t_u_list = self.get_t_u_list(x, r, v1)
-            omega_list = self.get_omega_list(x, r, v1, t_u_list)
-            estimator.many_measure(omega_list, t_u_list)
-            loss_omega_list[r] = (omega_list[-1] - estimator.mean_omega())**2
-            loss_v1_list[r] = (np.log(v1) - estimator.mean_log_v1())**2
+        """ get the losses for a large number of runs. the runs are fully
+            independent, so they are spread across all available cores """
+        results = Parallel(n_jobs=-1)(
+            delayed(self.do_run)(x, r) for r in range(n_runs) )
+        loss_omega_list, loss_v1_list = (np.array(l) for l in zip(*results))
         return loss_omega_list, loss_v1_list
     def x_trace(self, n_runs, x_list, x_list_nm):
         """ take a set of runs for each possible value of x
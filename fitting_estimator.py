@@ -46,16 +46,17 @@ class FittingEstimator(Estimator):
     def mean_log_v1(self):
         return np.nan # this type of estimator does not care about v1
     def many_measure(self, omega_list, t_u_list):
+        """ the chooser cycles through a fixed sequence of ts regardless of
+            the dist, so all the measurements can be drawn in one binomial
+            call instead of one np.random.binomial per shot """
         length = len(omega_list)
-        t_hist = []
-        for j in range(length):
-            t_idx = self.chooser.i
-            t = self.chooser.get_t(self.dist)
-            t_hist.append(t)
-            m = measure(omega_list[j], t)
-            if m == 1:
-                self.m1s[t_idx] += 1
-            self.counts[t_idx] += 1
+        ts = np.asarray(self.chooser.ts)
+        t_idxs = (self.chooser.i + np.arange(length)) % len(ts)
+        t_hist = ts[t_idxs]
+        ms = np.random.binomial(1, likelihood(np.asarray(omega_list), t_hist, 1))
+        np.add.at(self.m1s, t_idxs, ms)
+        np.add.at(self.counts, t_idxs, 1)
+        self.chooser.i = (self.chooser.i + length) % len(ts)
         return t_hist
 
 
@@ -53,10 +53,11 @@ class ExperimentalEstimator(Estimator):
             this fn ignores the t_u_list param """
         if whichts is None:
             whichts = np.arange(len(self.exp_ts))
-        for i in whichts:
-            if i > 0:
-                self.dist.wait_u(abs(self.exp_t_us[i] - self.exp_t_us[i-1])) # take abs to allow for reverse evaluation
-            self.dist.update(self.exp_ts[i], self.exp_ms[i])
+        ts = np.asarray(self.exp_ts)[whichts]
+        ms = np.asarray(self.exp_ms)[whichts]
+        t_us = np.asarray(self.exp_t_us)[whichts]
+        n_us = np.abs(np.diff(t_us)) # take abs to allow for reverse evaluation
+        self.dist.many_update(ts, ms, n_us)
 
 
 class FittingExperimentalEstimator(ExperimentalEstimator):
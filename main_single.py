@@ -21,14 +21,10 @@ def main():
     dynm = Estimator(DynamicDist2D(omegas, v1s, prior, num_particles), OptimizingChooser(10, 10))
     qinfer = Estimator(QinferDist2D(omegas, v1s, prior, num_particles), OptimizingChooser(10, 10))
     
-    th_grid = grid.many_measure(omega_list, t_u_list)
-    th_dynm = dynm.many_measure(omega_list, t_u_list)
-    th_qinfer = qinfer.many_measure(omega_list, t_u_list)
-    if False:
-        plt.plot(th_grid); plt.show()
-        plt.plot(th_dynm); plt.show()
-        #plt.plot(th_qinfer); plt.show()
-    
+    grid.many_measure(omega_list, t_u_list)
+    dynm.many_measure(omega_list, t_u_list)
+    qinfer.many_measure(omega_list, t_u_list)
+
     print(grid.dist.mean_omega(), dynm.dist.mean_omega())#, qinfer.dist.mean_omega())
     print('true: ', omega_list[-1])
     print('loss: ', (grid.dist.mean_omega() - omega_list[-1])**2)
@@ -37,11 +33,12 @@ def main():
     ax1 = plt.subplot(121)
     ax2 = plt.subplot(122, sharey=ax1)
     
+    grid_log_v1s = np.log(grid.dist.v1s[0]) # computed once for the extents below
     hlfd_omega = (grid.dist.omegas[1, 0] - grid.dist.omegas[0, 0]) / 2
-    hlfd_logv1 = (np.log(grid.dist.v1s[0, 1]) - np.log(grid.dist.v1s[0, 0])) / 2
+    hlfd_logv1 = (grid_log_v1s[1] - grid_log_v1s[0]) / 2
     ax2.imshow(grid.dist.dist, cmap=plt.get_cmap('Blues'),
         interpolation='nearest', aspect='auto',
-        extent=[np.log(grid.dist.v1s)[0, 0] - hlfd_logv1, np.log(grid.dist.v1s)[0, -1] + hlfd_logv1,
+        extent=[grid_log_v1s[0] - hlfd_logv1, grid_log_v1s[-1] + hlfd_logv1,
                 grid.dist.omegas[-1, 0] + hlfd_omega, grid.dist.omegas[0, 0] - hlfd_omega] )
     ax2.plot([np.log(v1)], [omega_list[-1]], marker='o', color='black')
     ax2.plot([grid.dist.mean_log_v1()], [grid.dist.mean_omega()], marker='o', color='tab:blue', mew=1, mec='black')
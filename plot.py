@@ -1,7 +1,20 @@
+import os
 import numpy as np
-from matplotlib import pyplot as plt
 from sys import argv
-from util import load_data, Bunch, diff, fn_from_source
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from util import load_data, diff, fn_from_source
+
+
+# matplotlib is imported lazily by main(), so importing this module as a
+# library skips pyplot's backend and font-cache startup cost
+plt = None
+
+def import_pyplot():
+    global plt, LineCollection, Line2D
+    from matplotlib import pyplot as plt
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
 
 
 """ usage:
@@ -16,6 +29,7 @@ from util import load_data, Bunch, diff, fn_from_source
     -dcnm   legend with just the dist name and chooser for each trace
     -o      plot the omega loss (default)
     -v      plot the v1 loss
+    -save   save the figure to <first filename>.png instead of showing it
 """
 
 
@@ -31,32 +45,117 @@ differfns = ['get_v1', 'get_omega_list', 'get_estimator']
 
 
 
+# numba is optional here (unlike in estimators.py): plot.py stays usable
+# standalone, and the kernel only matters for very large sweeps
+try:
+    from numba import njit, prange
+except ImportError:
+    _bounds_kernel = None
+else:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _bounds_kernel(y, u_y, lo, hi):
+        """ lo/hi error bounds in one fused parallel pass """
+        for i in prange(y.size):
+            lo[i] = y[i] - u_y[i]
+            hi[i] = y[i] + u_y[i]
+
+
+@lru_cache(maxsize=64)
+def cached_load_data(filename):
+    """ cached, so overlaying the same file several times only reads and
+        unpickles it once (Trace copies the entries, so sharing the dict
+        is safe) """
+    return load_data(filename)
+
+
+def _yerr(losses, means, y):
+    """ standard error on the rms loss y, built with in-place ufuncs
+        to avoid allocating temporaries on repeated plot calls """
+    u_y = np.std(losses, axis=1)
+    np.multiply(u_y, y, out=u_y)
+    u_y /= (2. * np.sqrt(losses.shape[1])) * means
+    return u_y
+
+
+# config for Trace.plot_loss, keyed by option letter:
+# (attribute holding the losses, legend label, colour attribute, y scale)
+loss_cfg = {
+    'o': ('loss_omegas', 'omega_loss', 'colour1', 'mu_omega'),
+    'v': ('loss_v1s', 'v1_loss', 'colour2', None),
+}
+
+
 # a line on a plot
 class Trace:
-    def __init__(self, b):
-        vars(self).update(vars(b))
+    def __init__(self, adict):
+        vars(self).update(adict)
         self.nm = ''
+        # store the losses as contiguous 2d arrays; fp32 is plenty for
+        # plotting and halves the memory traffic on big sweeps
+        for attr in ['loss_omegas', 'loss_v1s']:
+            losses = np.asarray(vars(self)[attr])
+            if losses.dtype == np.float64 and losses.size > 10_000:
+                losses = losses.astype(np.float32)
+            vars(self)[attr] = np.ascontiguousarray(losses)
     def __str__(self):
         return self.nm
-    def plot_omega_loss(self):
-        means = np.mean(self.loss_omegas, axis=1)
-        u_rel = np.std(self.loss_omegas, axis=1) / (np.sqrt(self.loss_omegas.shape[1]) * means)
-        y = np.sqrt(means) / self.mu_omega
-        u_y = 0.5 * u_rel * y
-        plt.errorbar(self.x_list, y, yerr=u_y, capsize=2,
-            label=('omega_loss' + self.nm), color=self.colour1)
-        y_med = np.sqrt(np.median(self.loss_omegas, axis=1)) / self.mu_omega
-        plt.plot(self.x_list, y_med,
-            linestyle='--', color=self.colour1)
-    def plot_v1_loss(self):
-        means = np.mean(self.loss_v1s, axis=1)
-        u_rel = np.std(self.loss_v1s, axis=1) / (np.sqrt(self.loss_v1s.shape[1]) * means)
-        y = np.sqrt(means)
-        u_y = 0.5 * u_rel * y
-        plt.errorbar(self.x_list, y, yerr=u_y, capsize=2,
-            label=('v1_loss' + self.nm), color=self.colour2)
-        plt.plot(self.x_list, np.sqrt(np.median(self.loss_v1s, axis=1)),
-            linestyle='--', color=self.colour2)
+    def loss_series(self, which):
+        """ assemble one loss curve as an
+            (x_list, y, u_y, y_med, label, colour) tuple,
+            leaving all matplotlib work to render_series """
+        losses_attr, label, colour_attr, scale_attr = loss_cfg[which]
+        losses = vars(self)[losses_attr]
+        colour = vars(self)[colour_attr]
+        means = np.mean(losses, axis=1)
+        # one vectorized sqrt over the stacked mean and median rows
+        y, y_med = np.sqrt(np.stack((
+            means, np.median(losses, axis=1) )))
+        if scale_attr is not None:
+            y, y_med = y / vars(self)[scale_attr], y_med / vars(self)[scale_attr]
+        u_y = _yerr(losses, means, y)
+        return np.asarray(self.x_list), y, u_y, y_med, label + self.nm, colour
+
+
+def render_series(series):
+    """ draw all loss curves at once: one LineCollection for the central
+        lines, one for the medians, and one for the error bars, instead
+        of a separate errorbar artist per curve """
+    ax = plt.gca()
+    lines, medians, colours = [], [], []
+    bars, bar_colours = [], []
+    cap_xs, cap_ys, cap_colours = [], [], []
+    for xs, y, u_y, y_med, label, colour in series:
+        lines.append(np.column_stack((xs, y)))
+        medians.append(np.column_stack((xs, y_med)))
+        colours.append(colour)
+        lo, hi = np.empty_like(y), np.empty_like(y)
+        if _bounds_kernel is not None and y.size > 50_000:
+            _bounds_kernel(y, u_y, lo, hi)
+        else: # jit payoff only shows up for large arrays
+            np.subtract(y, u_y, out=lo)
+            np.add(y, u_y, out=hi)
+        if xs.size > 20:
+            # dense sweep: a translucent band is one PolyCollection
+            # instead of per-point bars and caps
+            ax.fill_between(xs, lo, hi, color=colour, alpha=0.2)
+        else:
+            bars.append(np.stack((
+                np.column_stack((xs, lo)), np.column_stack((xs, hi)) ), axis=1))
+            bar_colours += [colour] * xs.size
+            cap_xs.append(np.concatenate((xs, xs)))
+            cap_ys.append(np.concatenate((lo, hi)))
+            cap_colours += [colour] * (2 * xs.size)
+        # proxy artist with no data, so plt.legend still sees one
+        # labelled line per curve
+        ax.add_line(Line2D([], [], color=colour, label=label))
+    ax.add_collection(LineCollection(lines, colors=colours))
+    ax.add_collection(LineCollection(medians, colors=colours, linestyles='--'))
+    if bars:
+        ax.add_collection(LineCollection(np.concatenate(bars),
+            colors=bar_colours, linewidths=1.))
+        plt.scatter(np.concatenate(cap_xs), np.concatenate(cap_ys),
+            color=cap_colours, marker='_', s=16)
+    ax.autoscale_view()
 
 
 def fnrep(fn):
@@ -99,20 +198,13 @@ def expand_names(traces):
 
 
 def v1_true(traces):
-    plt.xscale('log')
-    plt.yscale('log')
     plt.xlabel('v1_true')
 def n_measurements(traces):
-    plt.xscale('log')
-    plt.yscale('log')
     plt.xlabel('n_measurements')
 def t_ms(traces):
-    plt.yscale('log')
     #plt.plot(np.linspace(0., 0.0002, 100), 1e5*np.sin(70000*np.linspace(0., 0.0002, 100))**2)
     plt.xlabel('time of measurement')
 def v1_nom(traces):
-    plt.xscale('log')
-    plt.yscale('log')
     plt.xlabel('nominal v1')
     xmin, xmax, ymin, ymax = plt.axis()
     plt.plot([traces[0].v1_true] * 2, [ymin, ymax], label='v1_true')
@@ -128,6 +220,18 @@ plotfns = {
     'x_trace_nominal_v1': v1_nom,
 }
 
+# (logx, logy) per plottype; applied once, before any artists are drawn,
+# so the axis transforms are never recomputed
+plotscales = {
+    'est_var_omega_v1_true': (True, True),
+    'est_var_omega_n_measurements': (True, True),
+    'x_trace_n_ms': (True, True),
+    'x_trace_v1_true': (True, True),
+    'x_trace_t_ms': (False, True),
+    'x_trace_fit_shots': (True, True),
+    'x_trace_nominal_v1': (True, True),
+}
+
 
 # note: this version of the program does not have the property that all
 #   estimators see the same data
@@ -142,9 +246,22 @@ def main():
             filenames.append(arg)
     if not ('o' in options or 'v' in options):
         options.add('o') # default is the distplay omega_loss
-    
-    # make traces
-    traces = [Trace(Bunch(load_data(filename))) for filename in filenames]
+    if 'save' in options or not os.environ.get('DISPLAY'):
+        # skip GUI backend init when batch-rendering or running headless
+        import matplotlib
+        matplotlib.use('Agg')
+    import_pyplot()
+    plt.rcParams['path.simplify'] = True # cheaper rendering of dense curves
+    plt.rcParams['path.simplify_threshold'] = 1.0
+    plt.rcParams['agg.path.chunksize'] = 10000
+
+    # make traces, loading the files in parallel when there are several
+    # (all matplotlib work stays on this process)
+    if len(filenames) > 1:
+        with ProcessPoolExecutor() as pool:
+            traces = [Trace(data) for data in pool.map(load_data, filenames)]
+    else:
+        traces = [Trace(cached_load_data(filename)) for filename in filenames]
     colourmap = plt.get_cmap('jet')
     for i, t in enumerate(traces):
         t.colour1 = colourmap(i / len(traces))
@@ -165,15 +282,21 @@ def main():
                 t.chooser_name )
     
     # plot
+    logx, logy = plotscales.get(plottype, (False, False))
+    if logx:
+        plt.xscale('log')
+    if logy:
+        plt.yscale('log')
+    series = []
     for t in traces:
-        if 'o' in options:
-            t.plot_omega_loss()
-        if 'v' in options:
-            t.plot_v1_loss()
+        for which in loss_cfg:
+            if which in options:
+                series.append(t.loss_series(which))
+    render_series(series)
     
     # label
     if 'o' in options and 'v' in options:
-        plt.ylabel('omega_loss = $\\\\sqrt{langle(\\hat\\Omega - \\Omega)^2\\rangle} / \\mu_\\Omega$, v1_loss = $\\sqrt{\\langle(\\log\\hat v_1 - \\log v_1)^2\\rangle}$')
+        plt.ylabel('omega_loss = $\\sqrt{\\langle(\\hat\\Omega - \\Omega)^2\\rangle} / \\mu_\\Omega$, v1_loss = $\\sqrt{\\langle(\\log\\hat v_1 - \\log v_1)^2\\rangle}$')
     elif 'o' in options:
         plt.ylabel('omega loss $\\frac{\\sqrt{\\langle(\\hat\\Omega - \\Omega)^2\\rangle}}{\\mu_\\Omega}$')
     else:
@@ -267,7 +390,12 @@ def main():
 
     if 'l' in options or 'p' in options or 'dcnm' in options:
         plt.legend()
-    plt.show()
+    if 'save' in options:
+        outpath = filenames[0] + '.png'
+        plt.savefig(outpath, dpi=100)
+        print('Figure "%s" saved.' % outpath)
+    else:
+        plt.show()
 
 
 if __name__ == '__main__':
@@ -2,7 +2,6 @@ import pickle
 import datetime
 import math, random, string
 import numpy as np
-from qinfer import Distribution
 
 
 # constants
@@ -56,13 +55,9 @@ def get_numeric_class_vars(a_class):
 def deterministic_sample(n, p):
     cdf = np.cumsum(p)
     comparisons = np.linspace(1/(2*n), 1-1/(2*n), n)
-    ans = np.zeros(n, dtype=np.int64)
-    i = 0
-    for j in range(0, n):
-        while cdf[i] < comparisons[j]:
-            i += 1
-        ans[j] = i
-    return ans
+    # systematic resampling: for each comparison point, the index of the
+    # first cdf entry that reaches it
+    return np.searchsorted(cdf, comparisons)
 
 
 # given two strings, find the substring that differs between them,